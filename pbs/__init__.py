@@ -1,4 +1,4 @@
 """
 pbs package
 """
-__all__ = ["main", "build", "lookup"]
+__all__ = ["main", "build", "lookup", "shard"]
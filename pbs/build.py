@@ -8,7 +8,7 @@ import subprocess as sp
 from itertools import ifilter
 
 
-def __source_to_object_name(file_path):
+def source_to_object_name(file_path):
     """
     Transforms a filename from the convention of source code names to the
     convention of object code names.
@@ -20,7 +20,7 @@ def ccompile(source_file_path):
     """Compiles C source code into object code."""
     command = "cc -c {source_code} -o {object_code}".format(
         source_code=source_file_path,
-        object_code=__source_to_object_name(source_file_path))
+        object_code=source_to_object_name(source_file_path))
     execute(command)
 
 
@@ -55,7 +55,7 @@ def clink_many(directory_path, program_name):
 def make(file_path):
     """Compiles and links from source code into a program."""
     ccompile(file_path)
-    object_path = __source_to_object_name(file_path)
+    object_path = source_to_object_name(file_path)
     clink(object_path)
 
 
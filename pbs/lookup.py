@@ -1,7 +1,15 @@
 """
 Module to look up docstring descriptions in remote sites
 """
+import argparse
+import json
 import logging
+import math
+import os
+import Queue
+import re
+import threading
+import time
 from urllib import quote as url_quote
 
 import requests
@@ -10,6 +18,49 @@ from pyquery import PyQuery as pq
 SEARCH_URL = 'https://www.google.com/search?q=site:{0}%20{1}'
 SITE_URL = 'stackoverflow.com'
 NO_ANSWER_MSG = '< no answer given >'
+CANDIDATES = 3
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 5
+DEFAULT_HEDGE_DELAY = 2.0
+MIN_HEDGE_DELAY = 0.1
+REQUEST_TIMEOUT = 10
+CONCURRENT_LOOKUPS = 4
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60}
+
+
+class Latencies(object):
+    """
+    Records durations, in seconds, from any thread, and summarizes them as
+    percentiles.
+    """
+
+    def __init__(self):
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        """Records a duration in seconds."""
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent):
+        """
+        Returns the nearest-rank percentile of the recorded durations, or None
+        if nothing was recorded.
+        """
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        rank = int(math.ceil(percent / 100.0 * len(ordered)))
+        return ordered[max(rank, 1) - 1]
+
+
+fetch_latencies = Latencies()
+lookup_latencies = Latencies()
 
 
 class Page(object):
@@ -28,8 +79,9 @@ class Page(object):
     def retrieve(self):
         """Retrieves the contents of a URL as text."""
         try:
-            return requests.get(self.url).text
-        except requests.exceptions.ConnectionError:
+            return requests.get(self.url, timeout=REQUEST_TIMEOUT).text
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
             logging.exception("Error retrieving URL %s", self.url)
 
     def get_all_links(self):
@@ -58,9 +110,14 @@ class SearchHit(object):
         Returns the first link on the search hits page, and it removes the
         bad prefix (`/url?q=`) usually found in these links.
         """
-        all_links = self.page.get_all_links()
-        first_link = all_links[0]
-        return first_link[7:]
+        return self.top_links(1)[0]
+
+    def top_links(self, count):
+        """
+        Returns the first `count` links on the search hits page, without the
+        bad prefix (`/url?q=`) usually found in these links.
+        """
+        return [link[7:] for link in self.page.get_all_links()[:count]]
 
 
 class Answer(object):
@@ -94,13 +151,123 @@ class Answer(object):
         return self._text
 
 
+class AnswerCache(object):
+    """
+    An AnswerCache keeps the usable answers found for each query in a JSON
+    file, so that later builds, or other processes, do not look them up again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.answers = self.read()
+
+    def read(self):
+        """Reads the answers saved in the cache file, if any."""
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r') as cache_file:
+            return json.load(cache_file)
+
+    def get(self, query):
+        """Returns the cached answer to a query, or None."""
+        return self.answers.get(query)
+
+    def update(self, answers):
+        """
+        Adds the usable answers from a dictionary keyed by query, and saves
+        them along with any answers saved meanwhile by other processes.
+        """
+        usable = dict((query, answer) for query, answer in answers.items()
+                      if answer != NO_ANSWER_MSG)
+        if not usable:
+            return
+        self.answers = self.read()
+        self.answers.update(usable)
+        temporary_path = "{0}.{1}".format(self.path, os.getpid())
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(self.answers, cache_file, indent=2, sort_keys=True)
+        os.rename(temporary_path, self.path)
+
+
+class Lookups(object):
+    """
+    Searches for a number of queries in background threads, so that the build
+    can go on meanwhile, and gives access to the answers found by a deadline.
+    """
+
+    def __init__(self, queries, concurrency=CONCURRENT_LOOKUPS):
+        self.queries = list(queries)
+        self.answers = {}
+        self.durations = {}
+        self.lock = threading.Lock()
+        self.pending = Queue.Queue()
+        for query in self.queries:
+            self.pending.put(query)
+        self.workers = []
+        for _ in range(min(concurrency, len(self.queries))):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        """Searches for pending queries until there are none left."""
+        while True:
+            try:
+                query = self.pending.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                answer = search(query)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Error looking up '%s'", query)
+                answer = NO_ANSWER_MSG
+            with self.lock:
+                self.answers[query] = answer
+                self.durations[query] = time.time() - start
+
+    def wait(self, deadline=None):
+        """
+        Waits for the lookups to finish, or until the `deadline` given as a
+        `time.time()` value, whatever happens first.
+
+        :returns: a tuple with a dictionary of the answers found, keyed by
+            query, and a sorted list of the queries still pending, deferred
+        """
+        for worker in self.workers:
+            if deadline is None:
+                worker.join()
+            else:
+                worker.join(max(deadline - time.time(), 0))
+        with self.lock:
+            answers = dict(self.answers)
+        deferred = sorted(set(self.queries) - set(answers))
+        return answers, deferred
+
+
+def parse_duration(text):
+    """
+    Parses a duration such as `5s`, `500ms` or `2m` into seconds. A number
+    without units is taken as seconds.
+    """
+    match = re.match(r'^(\d+(?:\.\d+)?)(ms|s|m)?$', text.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            "invalid duration '{0}', expected e.g. 5s or 500ms".format(text))
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
 def search(query):
     """
     Searches for the given query on a search engine, then gets the answer
     from the links that point to the search hits
     """
+    start = time.time()
     links = get_search_hits(query)
-    return get_answer(links)
+    answer = get_answer(links)
+    lookup_latencies.record(time.time() - start)
+    return answer
 
 
 def get_search_hits(query):
@@ -115,12 +282,67 @@ def get_search_hits(query):
     return search_hits
 
 
-def get_answer(search_hits):
+def hedge_delay():
+    """
+    Returns how long, in seconds, to wait for an answer page before fetching a
+    backup candidate: the usual slow latency of previous fetches, or a default
+    until enough fetches have been timed.
+    """
+    if len(fetch_latencies) < HEDGE_MIN_SAMPLES:
+        return DEFAULT_HEDGE_DELAY
+    return max(fetch_latencies.percentile(HEDGE_PERCENTILE), MIN_HEDGE_DELAY)
+
+
+def fetch_answer(link):
+    """Fetches the answer text from the page a link points to."""
+    html = Page(link + '?answertab=votes')
+    return Answer(html).text
+
+
+def _fetch_into(link, results):
+    """
+    Fetches the answer text from a link, timing the fetch, and puts the text
+    into a queue of results; None is put if the fetch fails.
+    """
+    start = time.time()
+    try:
+        text = fetch_answer(link)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception("Error fetching answer from %s", link)
+        text = None
+    fetch_latencies.record(time.time() - start)
+    results.put(text)
+
+
+def get_answer(search_hits, candidates=CANDIDATES):
     """
     Get the answer text from a number of search hits. The answer will
     preferently be the code associated with the answer; if no code is present,
     then the answer's natural text will be returned.
+
+    Up to `candidates` links are tried in order. The next one is fetched as a
+    backup whenever the fetches in flight take longer than the
+    :func:`hedge_delay`, or as soon as one of them gives no usable answer. The
+    first usable answer wins, and the fetches still in flight are abandoned.
     """
-    link = search_hits.first_link
-    html = Page(link + '?answertab=votes')
-    return Answer(html).text
+    links = iter(search_hits.top_links(candidates))
+    results = Queue.Queue()
+    delay = hedge_delay()
+    in_flight = 0
+    while True:
+        link = next(links, None)
+        if link is not None:
+            worker = threading.Thread(
+                target=_fetch_into, args=(link, results))
+            worker.daemon = True
+            worker.start()
+            in_flight += 1
+        if not in_flight:
+            return NO_ANSWER_MSG
+        try:
+            text = results.get(timeout=delay)
+        except Queue.Empty:
+            continue
+        in_flight -= 1
+        if text is not None and text != NO_ANSWER_MSG:
+            return text
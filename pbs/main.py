@@ -1,34 +1,127 @@
 """
 Main module
 """
+import argparse
+import json
 import os
 import logging
+import subprocess as sp
+import sys
 
 import pbs.build
 import pbs.comments
 import pbs.lookup
+import pbs.shard
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 
-def main():
+def parse_args(argv=None):
+    """Parses the command line arguments."""
+    parser = argparse.ArgumentParser(
+        prog='pbs', description='Planetary Build System')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        '--shard', type=pbs.shard.parse_shard, metavar='I/N',
+        help=('compile and look up only the I-th of N shares of the source '
+              'files, leaving a manifest to be merged later'))
+    group.add_argument(
+        '--merge', action='store_true',
+        help='merge the manifests and objects of all shards into a program')
+    group.add_argument('--fill', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--lookup-budget', type=pbs.lookup.parse_duration, metavar='TIME',
+        help=('stop waiting for lookups after TIME, e.g. 5s, and finish them '
+              'in the background for the next build'))
+    return parser.parse_args(argv)
+
+
+def report(manifest):
+    """Logs the answer found for every procedure in a manifest."""
+    for procedure, comments, query in manifest['procedures']:
+        if query in manifest['answers']:
+            logging.info(
+                "Found this answer for procedure '%s' described as '%s':\n %s",
+                procedure, comments, manifest['answers'][query])
+        else:
+            logging.info(
+                "Deferred the lookup for procedure '%s' described as '%s'",
+                procedure, comments)
+    if manifest['deferred']:
+        logging.info(
+            "%d lookups deferred past the lookup budget; their answers will "
+            "be shown on the next build", len(manifest['deferred']))
+
+
+def report_latency():
+    """Logs the median and tail latency of the lookups done by this process."""
+    latencies = pbs.lookup.lookup_latencies
+    if len(latencies):
+        logging.info(
+            "Lookup latency over %d lookups: p50 %.2fs, p99 %.2fs",
+            len(latencies), latencies.percentile(50),
+            latencies.percentile(99))
+
+
+def fill_in_background(directory, queries):
+    """
+    Starts a detached pbs process that looks up the queries and saves their
+    answers in the answer cache of a directory. The lookups start over, since
+    those in flight in this process stop when it exits.
+    """
+    if not queries:
+        return
+    with open(os.devnull, 'w') as devnull:
+        process = sp.Popen(
+            [sys.executable, '-m', 'pbs.main', '--fill'],
+            cwd=directory, stdin=sp.PIPE, stdout=devnull, stderr=devnull,
+            close_fds=True, preexec_fn=getattr(os, 'setsid', None))
+    json.dump(queries, process.stdin)
+    process.stdin.close()
+
+
+def fill(directory, queries):
+    """Looks up the queries and saves their answers in the answer cache."""
+    cache = pbs.lookup.AnswerCache(
+        os.path.join(directory, pbs.shard.ANSWERS_FILENAME))
+    answers, _ = pbs.lookup.Lookups(queries).wait()
+    cache.update(answers)
+
+
+def main(argv=None):
     """Main entry point."""
+    args = parse_args(argv)
     current_dir = os.getcwd()
     project_name = os.path.basename(current_dir)
-    parser = pbs.comments.Parser()
-    for filename in os.listdir(current_dir):
-        language = parser.infer_language(filename)
-        with open(filename, 'r') as source_file:
-            procedure_comments = parser.parse(source_file.readlines())
-        for procedure, comments in procedure_comments.iteritems():
-            answer = pbs.lookup.search(comments + " in " + language)
-            logging.info(
-                "Found this answer for procedure '%s' described as '%s':\n %s",
-                procedure, comments, answer)
-        pbs.build.ccompile(filename)
+    if args.fill:
+        fill(current_dir, json.load(sys.stdin))
+        return 0
+    if args.merge:
+        try:
+            manifest = pbs.shard.merge(current_dir, pbs.comments.Parser())
+        except ValueError as error:
+            logging.error("Cannot merge shards: %s", error)
+            return 1
+    else:
+        index, count = args.shard or (1, 1)
+        parser = pbs.comments.Parser()
+        manifest = pbs.shard.build_shard(
+            current_dir, parser, index, count, args.lookup_budget)
+        if args.shard:
+            pbs.shard.write_manifest(current_dir, manifest)
+            logging.info("Built shard %d/%d: %d files, %d lookups, "
+                         "%d deferred", index, count,
+                         len(manifest['objects']), len(manifest['answers']),
+                         len(manifest['deferred']))
+            report_latency()
+            return 0
+    report(manifest)
+    report_latency()
     pbs.build.clink_many(current_dir, project_name)
+    fill_in_background(current_dir, manifest['deferred'])
+    return 0
 
 
-if __name__ == '__main__':
-    main()
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+Module to split a build across several processes, possibly on different
+machines, and to merge their results back into a single program.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os.path
+import time
+
+import pbs.build
+import pbs.lookup
+
+COSTS_FILENAME = '.pbs-costs.json'
+ANSWERS_FILENAME = '.pbs-answers.json'
+MANIFEST_FILENAME = '.pbs-shard-{index}-of-{count}.json'
+MANIFEST_PATTERN = '.pbs-shard-*-of-*.json'
+DEFAULT_COST = 1.0
+
+
+def parse_shard(text):
+    """
+    Parses a shard specification of the form `i/n`, where `n` is the total
+    number of shards and `i` is the 1-based index of one of them.
+
+    :returns: a tuple `(index, count)`
+    """
+    try:
+        index, count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{0}', expected the form i/n".format(text))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{0}', expected 1 <= i <= n".format(text))
+    return index, count
+
+
+def stable_hash(text):
+    """
+    Hashes a text into an integer that is the same on every machine and in
+    every process, unlike the builtin `hash`. Byte strings, such as filenames
+    from `os.listdir`, are hashed as they are; unicode strings as UTF-8.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return int(hashlib.md5(text).hexdigest(), 16)
+
+
+def _bytes(name):
+    """
+    Encodes a filename read from a JSON file to UTF-8, so that it can be
+    compared with the byte strings from `os.listdir`. Byte strings are left
+    as they are, since they may not be valid UTF-8.
+    """
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+
+def source_files(directory, parser):
+    """Lists, sorted, the files under a directory that the parser can read."""
+    return sorted(fn for fn in os.listdir(directory)
+                  if os.path.splitext(fn)[1] in parser.LANGUAGE)
+
+
+def load_costs(directory):
+    """
+    Loads the cost, in seconds, that each source file took to build in
+    previous runs. Returns an empty dictionary if no costs were recorded.
+    """
+    path = os.path.join(directory, COSTS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as costs_file:
+        return json.load(costs_file)
+
+
+def save_costs(directory, costs):
+    """Records the cost, in seconds, that each source file took to build."""
+    with open(os.path.join(directory, COSTS_FILENAME), 'w') as costs_file:
+        json.dump(costs, costs_file, indent=2, sort_keys=True)
+
+
+def partition(filenames, count, costs=None):
+    """
+    Partitions filenames into `count` shares of similar total cost.
+
+    Files are placed, most expensive first, on the share with the lowest total
+    cost so far. Files without a recorded cost are assumed to cost the average
+    of the recorded ones. Ties are broken by a stable hash of the filename, so
+    every process given the same filenames and costs computes the same
+    partition.
+
+    :returns: a list of `count` sorted lists of filenames
+    """
+    costs = dict((_bytes(name), cost) for name, cost in (costs or {}).items())
+    default = (sum(costs.values()) / len(costs)) if costs else DEFAULT_COST
+    loads = [0.0] * count
+    shares = [[] for _ in range(count)]
+    ordered = sorted(
+        filenames,
+        key=lambda fn: (-costs.get(_bytes(fn), default), stable_hash(fn)))
+    for filename in ordered:
+        target = min(range(count), key=lambda i: (loads[i], i))
+        shares[target].append(filename)
+        loads[target] += costs.get(_bytes(filename), default)
+    return [sorted(share) for share in shares]
+
+
+def build_shard(directory, parser, index=1, count=1, budget=None):
+    """
+    Compiles and looks up the share of the source files under a directory that
+    belongs to the shard `index` out of `count`.
+
+    Every file is parsed, so that each query is looked up only by the shard
+    owning the first file, in sorted order, where that query appears. Queries
+    with an answer in the answer cache are not looked up again. The rest are
+    looked up while the files are compiled; those still pending after `budget`
+    seconds, if given, are deferred.
+
+    :returns: a manifest dictionary with the files and costs partitioned,
+        the share of files built, the objects compiled, the answers found,
+        the queries deferred, the procedures described, and the cost of each
+        file
+    """
+    start = time.time()
+    filenames = source_files(directory, parser)
+    costs = load_costs(directory)
+    share = partition(filenames, count, costs)[index - 1]
+    owners = {}
+    procedures = {}
+    for filename in filenames:
+        language = parser.infer_language(filename)
+        with open(os.path.join(directory, filename), 'r') as source_file:
+            procedure_comments = parser.parse(source_file.readlines())
+        procedures[filename] = []
+        for procedure, comments in sorted(procedure_comments.items()):
+            query = comments + " in " + language
+            owners.setdefault(query, filename)
+            procedures[filename].append([procedure, comments, query])
+    owned = dict((filename, [query for _, _, query in procedures[filename]
+                             if owners[query] == filename])
+                 for filename in share)
+    cache = pbs.lookup.AnswerCache(os.path.join(directory, ANSWERS_FILENAME))
+    cached = dict((query, cache.get(query)) for queries in owned.values()
+                  for query in queries if cache.get(query) is not None)
+    lookups = pbs.lookup.Lookups(sorted(
+        query for queries in owned.values() for query in queries
+        if query not in cached))
+    manifest = {
+        'shard': [index, count],
+        'sources': filenames,
+        'partition_costs': costs,
+        'share': share,
+        'objects': [],
+        'answers': cached,
+        'deferred': [],
+        'procedures': [],
+        'costs': {}}
+    for filename in share:
+        compile_start = time.time()
+        manifest['procedures'].extend(procedures[filename])
+        pbs.build.ccompile(os.path.join(directory, filename))
+        manifest['objects'].append(
+            pbs.build.source_to_object_name(filename))
+        manifest['costs'][filename] = time.time() - compile_start
+    answers, manifest['deferred'] = lookups.wait(
+        None if budget is None else start + budget)
+    cache.update(answers)
+    manifest['answers'].update(answers)
+    elapsed = time.time() - start
+    for filename in share:
+        manifest['costs'][filename] += sum(
+            lookups.durations.get(query, elapsed)
+            for query in owned[filename] if query not in cached)
+    return manifest
+
+
+def write_manifest(directory, manifest):
+    """Writes the manifest of a shard under the directory."""
+    index, count = manifest['shard']
+    path = os.path.join(
+        directory, MANIFEST_FILENAME.format(index=index, count=count))
+    with open(path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+
+def check_shares(directory, parser, manifests):
+    """
+    Checks that the manifests of all shards partitioned the same files with
+    the same costs, and that their shares cover the source files under the
+    directory exactly once.
+    """
+    if any(manifest['sources'] != manifests[0]['sources'] or
+           manifest['partition_costs'] != manifests[0]['partition_costs']
+           for manifest in manifests):
+        raise ValueError(
+            "Shards partitioned different files or costs; build every shard "
+            "from the same source files and " + COSTS_FILENAME)
+    built = sorted(_bytes(fn) for manifest in manifests
+                   for fn in manifest['share'])
+    expected = source_files(directory, parser)
+    repeated = sorted(set(fn for fn in built if built.count(fn) > 1))
+    if repeated:
+        raise ValueError(
+            "Files built by more than one shard: " + ", ".join(repeated))
+    missing = sorted(set(expected) - set(built))
+    if missing:
+        raise ValueError("Files built by no shard: " + ", ".join(missing))
+    unexpected = sorted(set(built) - set(expected))
+    if unexpected:
+        raise ValueError(
+            "Files built but no longer found: " + ", ".join(unexpected))
+
+
+def merge(directory, parser):
+    """
+    Merges the manifests of all shards found under a directory, checking that
+    every shard, and every object file it compiled, is present, and that the
+    shards built every source file exactly once. The costs measured by the
+    shards are recorded for the partition of future builds, and their answers
+    are saved in the answer cache of the directory. The manifests are removed,
+    so that they do not get mixed with those of the next build.
+
+    :returns: a merged manifest dictionary
+    """
+    paths = sorted(glob.glob(os.path.join(directory, MANIFEST_PATTERN)))
+    manifests = []
+    for path in paths:
+        with open(path, 'r') as manifest_file:
+            manifests.append(json.load(manifest_file))
+    if not manifests:
+        raise ValueError("No shard manifests found in " + directory)
+    counts = sorted(set(manifest['shard'][1] for manifest in manifests))
+    if len(counts) > 1:
+        raise ValueError(
+            "Found manifests of builds with different numbers of shards: " +
+            "; ".join("shards {0} of {1}".format(
+                sorted(manifest['shard'][0] for manifest in manifests
+                       if manifest['shard'][1] == count), count)
+                      for count in counts) +
+            "; remove the manifests of earlier builds")
+    count = counts[0]
+    found = sorted(manifest['shard'][0] for manifest in manifests)
+    if found != range(1, count + 1):
+        raise ValueError(
+            "Expected shards 1 to {0} of {0}, found {1}".format(count, found))
+    check_shares(directory, parser, manifests)
+    merged = {
+        'shard': [1, 1],
+        'objects': [],
+        'answers': {},
+        'deferred': [],
+        'procedures': [],
+        'costs': load_costs(directory)}
+    for manifest in sorted(manifests, key=lambda m: m['shard']):
+        merged['objects'].extend(manifest['objects'])
+        merged['answers'].update(manifest['answers'])
+        merged['deferred'].extend(manifest['deferred'])
+        merged['procedures'].extend(manifest['procedures'])
+        merged['costs'].update(manifest['costs'])
+    missing = [obj for obj in merged['objects']
+               if not os.path.exists(os.path.join(directory, obj))]
+    if missing:
+        raise ValueError("Missing object files: " + ", ".join(missing))
+    merged['deferred'].sort()
+    pbs.lookup.AnswerCache(
+        os.path.join(directory, ANSWERS_FILENAME)).update(merged['answers'])
+    save_costs(directory, merged['costs'])
+    for path in paths:
+        os.remove(path)
+    return merged
@@ -1,12 +1,16 @@
 """
 Tests for the module that looks up the meaning of docstrings in some Web server
 """
+import argparse
 import os
+import shutil
+import tempfile
+import time
 from textwrap import dedent
 
 import mock
 import nose.tools as nt
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, ReadTimeout
 
 import pbs.lookup
 
@@ -37,6 +41,20 @@ class TestPage(object):
         assert_not_raises(ConnectionError, pbs.lookup.Page, url)
         mock_log.assert_called_once_with('Error retrieving URL %s', url)
 
+    @staticmethod
+    @mock.patch('logging.exception')
+    @mock.patch('requests.get')
+    def test_timeout(mock_get, mock_log):
+        """
+        What happens when a Page takes too long to be retrieved.
+        """
+        url = "slow url"
+        mock_get.side_effect = ReadTimeout("Too slow!")
+        assert_not_raises(ReadTimeout, pbs.lookup.Page, url)
+        mock_get.assert_called_once_with(
+            url, timeout=pbs.lookup.REQUEST_TIMEOUT)
+        mock_log.assert_called_once_with('Error retrieving URL %s', url)
+
 
 @mock.patch('pbs.lookup.Page.retrieve')
 def test_get_links(mock_retrieve):
@@ -72,6 +90,9 @@ def test_get_links(mock_retrieve):
     ]
     for link, title in zip(links, expected_titles):
         nt.assert_true(title in link)
+    top_links = search_hits.top_links(3)
+    nt.assert_equal([link[7:] for link in links[:3]], top_links)
+    nt.assert_equal(top_links[0], search_hits.first_link)
 
 
 @mock.patch('pbs.lookup.Page.retrieve')
@@ -170,6 +191,178 @@ def test_search_no_answer(mock_search_hits, mock_retrieve):
     nt.assert_equal(answer, pbs.lookup.NO_ANSWER_MSG)
 
 
+def test_latencies():
+    """How latencies are summarized as percentiles"""
+    latencies = pbs.lookup.Latencies()
+    nt.assert_is_none(latencies.percentile(50))
+    for seconds in [0.5, 0.1, 0.4, 0.2, 0.3]:
+        latencies.record(seconds)
+    nt.assert_equal(5, len(latencies))
+    nt.assert_equal(0.1, latencies.percentile(0))
+    nt.assert_equal(0.3, latencies.percentile(50))
+    nt.assert_equal(0.5, latencies.percentile(99))
+
+
+@mock.patch('pbs.lookup.fetch_latencies', new_callable=pbs.lookup.Latencies)
+def test_hedge_delay(mock_latencies):
+    """How long to wait for an answer before fetching a backup"""
+    nt.assert_equal(pbs.lookup.DEFAULT_HEDGE_DELAY, pbs.lookup.hedge_delay())
+    for seconds in [0.2, 0.3, 0.4, 0.5, 0.6]:
+        mock_latencies.record(seconds)
+    nt.assert_equal(0.6, pbs.lookup.hedge_delay())
+    mock_latencies.samples = [0.0] * 5
+    nt.assert_equal(pbs.lookup.MIN_HEDGE_DELAY, pbs.lookup.hedge_delay())
+
+
+class TestHedgedAnswer(object):
+    """
+    How the answer is fetched from several candidate links
+    """
+
+    def __init__(self):
+        self.search_hits = None
+        self.delays = None
+
+    def setup(self):
+        """
+        Search hits pointing to three candidate answers
+        """
+        self.search_hits = mock.Mock()
+        self.search_hits.top_links.return_value = ["one", "two", "three"]
+        self.delays = {"one": 0, "two": 0, "three": 0}
+
+    def fetch_answer(self, link):
+        """Fetches the answer text after a delay set for each link."""
+        if self.delays[link] is None:
+            raise ConnectionError("Wrong!")
+        time.sleep(self.delays[link])
+        return "answer from " + link
+
+    def get_answer(self):
+        """Gets the answer with a short hedge delay."""
+        with mock.patch('pbs.lookup.fetch_answer', wraps=self.fetch_answer) \
+                as mock_fetch, \
+                mock.patch('pbs.lookup.hedge_delay', return_value=0.1):
+            answer = pbs.lookup.get_answer(self.search_hits)
+        return answer, [args[0][0] for args in mock_fetch.call_args_list]
+
+    def test_first_answer(self):
+        """A fast first candidate is the only one fetched"""
+        answer, fetched = self.get_answer()
+        nt.assert_equal("answer from one", answer)
+        nt.assert_equal(["one"], fetched)
+        self.search_hits.top_links.assert_called_once_with(
+            pbs.lookup.CANDIDATES)
+
+    def test_slow_answer_is_hedged(self):
+        """A slow candidate is raced by a backup, and the fastest wins"""
+        self.delays["one"] = 1
+        answer, fetched = self.get_answer()
+        nt.assert_equal("answer from two", answer)
+        nt.assert_equal(["one", "two"], fetched)
+
+    @mock.patch('logging.exception')
+    def test_failed_answers_are_skipped(self, mock_log):
+        """Candidates without usable answers are replaced at once"""
+        self.delays["one"] = None
+        self.delays["two"] = None
+        answer, fetched = self.get_answer()
+        nt.assert_equal("answer from three", answer)
+        nt.assert_equal(["one", "two", "three"], fetched)
+        nt.assert_equal(2, mock_log.call_count)
+
+    @mock.patch('logging.exception')
+    def test_no_usable_answer(self, _):
+        """What happens when no candidate gives a usable answer"""
+        with mock.patch('pbs.lookup.fetch_answer', side_effect=[
+                ConnectionError("Wrong!"), pbs.lookup.NO_ANSWER_MSG,
+                ConnectionError("Wrong!")]), \
+                mock.patch('pbs.lookup.hedge_delay', return_value=0.1):
+            answer = pbs.lookup.get_answer(self.search_hits)
+        nt.assert_equal(pbs.lookup.NO_ANSWER_MSG, answer)
+
+
+def test_parse_duration():
+    """How a lookup budget is given on the command line"""
+    nt.assert_equal(5.0, pbs.lookup.parse_duration("5s"))
+    nt.assert_equal(5.0, pbs.lookup.parse_duration("5"))
+    nt.assert_equal(0.5, pbs.lookup.parse_duration("500ms"))
+    nt.assert_equal(90.0, pbs.lookup.parse_duration("1.5m"))
+    for text in ["", "s", "5h", "-5s"]:
+        nt.assert_raises(argparse.ArgumentTypeError,
+                         pbs.lookup.parse_duration, text)
+
+
+class TestAnswerCache(object):
+    """
+    How answers are kept between builds
+    """
+
+    def __init__(self):
+        self.tmpdirname = None
+        self.path = None
+
+    def setup(self):
+        """
+        A cache file in an empty directory
+        """
+        self.tmpdirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdirname, "answers.json")
+
+    def teardown(self):
+        """
+        Cleanup after tests
+        """
+        shutil.rmtree(self.tmpdirname)
+
+    def test_update(self):
+        """Usable answers are saved, along with those of other processes"""
+        cache = pbs.lookup.AnswerCache(self.path)
+        nt.assert_is_none(cache.get("query"))
+        cache.update({"query": pbs.lookup.NO_ANSWER_MSG})
+        nt.assert_false(os.path.exists(self.path))
+        other = pbs.lookup.AnswerCache(self.path)
+        other.update({"other query": "other answer"})
+        cache.update({"query": "answer"})
+        nt.assert_equal({"query": "answer", "other query": "other answer"},
+                        pbs.lookup.AnswerCache(self.path).answers)
+        nt.assert_equal(["answers.json"], os.listdir(self.tmpdirname))
+
+
+class TestLookups(object):
+    """
+    How queries are looked up in the background
+    """
+
+    @staticmethod
+    def search(query):
+        """Searches after a delay given by the query."""
+        if query == "broken":
+            raise ConnectionError("Wrong!")
+        time.sleep(float(query))
+        return "answer to " + query
+
+    @mock.patch('logging.exception')
+    def test_wait(self, mock_log):
+        """All lookups finish when no deadline is given"""
+        with mock.patch('pbs.lookup.search', wraps=self.search):
+            lookups = pbs.lookup.Lookups(["0", "0.1", "broken"])
+            answers, deferred = lookups.wait()
+        nt.assert_equal({"0": "answer to 0", "0.1": "answer to 0.1",
+                         "broken": pbs.lookup.NO_ANSWER_MSG}, answers)
+        nt.assert_equal([], deferred)
+        nt.assert_equal(set(answers), set(lookups.durations))
+        nt.assert_equal(1, mock_log.call_count)
+
+    def test_deadline(self):
+        """Lookups still pending at the deadline are deferred"""
+        with mock.patch('pbs.lookup.search', wraps=self.search):
+            lookups = pbs.lookup.Lookups(["0", "0.5", "0.6"], concurrency=2)
+            answers, deferred = lookups.wait(time.time() + 0.2)
+        nt.assert_equal({"0": "answer to 0"}, answers)
+        nt.assert_equal(["0.5", "0.6"], deferred)
+
+
 def assert_not_raises(exception, func, *args, **kwargs):
     """
     Asserts that a function `func` called with `args` and `kwargs` does not
@@ -0,0 +1,170 @@
+"""
+Tests for the main module, which runs pbs from the command line.
+"""
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+
+import mock
+import nose.tools as nt
+
+import pbs.lookup
+import pbs.main
+import pbs.shard
+
+
+def test_parse_args():
+    """How pbs is called from the command line"""
+    args = pbs.main.parse_args([])
+    nt.assert_equal((None, False, False, None), (
+        args.shard, args.merge, args.fill, args.lookup_budget))
+    args = pbs.main.parse_args(['--shard', '2/3', '--lookup-budget', '5s'])
+    nt.assert_equal(((2, 3), 5.0), (args.shard, args.lookup_budget))
+    nt.assert_true(pbs.main.parse_args(['--merge']).merge)
+    with mock.patch('sys.stderr'):
+        nt.assert_raises(SystemExit, pbs.main.parse_args,
+                         ['--shard', '1/2', '--merge'])
+
+
+@mock.patch('logging.info')
+def test_report(mock_log):
+    """How answers, and lookups deferred past the budget, are reported"""
+    pbs.main.report({
+        'answers': {"found in C": "answer"},
+        'deferred': ["slow in C"],
+        'procedures': [["int found()", "found", "found in C"],
+                       ["int slow()", "slow", "slow in C"]]})
+    nt.assert_equal([
+        mock.call("Found this answer for procedure '%s' described as "
+                  "'%s':\n %s", "int found()", "found", "answer"),
+        mock.call("Deferred the lookup for procedure '%s' described as '%s'",
+                  "int slow()", "slow"),
+        mock.call("%d lookups deferred past the lookup budget; their answers "
+                  "will be shown on the next build", 1)],
+                    mock_log.call_args_list)
+
+
+@mock.patch('logging.info')
+def test_report_nothing_deferred(mock_log):
+    """Nothing is said about deferred lookups when there are none"""
+    pbs.main.report({'answers': {}, 'deferred': [], 'procedures': []})
+    nt.assert_false(mock_log.called)
+
+
+@mock.patch('logging.info')
+@mock.patch('pbs.lookup.lookup_latencies', new_callable=pbs.lookup.Latencies)
+def test_report_latency(mock_latencies, mock_log):
+    """How the latency of the lookups is reported"""
+    pbs.main.report_latency()
+    nt.assert_false(mock_log.called)
+    for seconds in [0.1, 0.2, 0.3]:
+        mock_latencies.record(seconds)
+    pbs.main.report_latency()
+    mock_log.assert_called_once_with(
+        "Lookup latency over %d lookups: p50 %.2fs, p99 %.2fs", 3, 0.2, 0.3)
+
+
+@mock.patch('pbs.main.sp.Popen')
+def test_fill_in_background(mock_popen):
+    """How deferred lookups are handed to a detached pbs process"""
+    pbs.main.fill_in_background("project", [])
+    nt.assert_false(mock_popen.called)
+    written = []
+    mock_popen.return_value.stdin.write.side_effect = written.append
+    queries = ["slow in C", "-starts with a dash in C"]
+    pbs.main.fill_in_background("project", queries)
+    args, kwargs = mock_popen.call_args
+    nt.assert_equal(([sys.executable, '-m', 'pbs.main', '--fill'],), args)
+    nt.assert_equal("project", kwargs['cwd'])
+    nt.assert_equal(pbs.main.sp.PIPE, kwargs['stdin'])
+    nt.assert_equal(queries, json.loads("".join(written)))
+    mock_popen.return_value.stdin.close.assert_called_once_with()
+
+
+class TestMain(object):
+    """
+    How the main entry point builds the project in the current directory
+    """
+
+    def __init__(self):
+        self.tmpdirname = None
+        self.manifest = None
+
+    def setup(self):
+        """
+        An empty project directory, and the manifest of a build with one
+        lookup deferred
+        """
+        self.tmpdirname = tempfile.mkdtemp()
+        self.manifest = {
+            'shard': [1, 1],
+            'objects': [],
+            'answers': {},
+            'deferred': ["slow in C"],
+            'procedures': []}
+
+    def teardown(self):
+        """
+        Cleanup after tests
+        """
+        shutil.rmtree(self.tmpdirname)
+
+    def main(self, argv, stdin=""):
+        """Runs pbs with some arguments in the project directory."""
+        with mock.patch('os.getcwd', return_value=self.tmpdirname), \
+                mock.patch('sys.stdin', StringIO(stdin)):
+            return pbs.main.main(argv)
+
+    def test_fill(self):
+        """The background process saves the answers it finds"""
+        with mock.patch('pbs.lookup.search', return_value="answer"):
+            nt.assert_equal(0, self.main(['--fill'], '["slow in C"]'))
+        cache = pbs.lookup.AnswerCache(
+            os.path.join(self.tmpdirname, pbs.shard.ANSWERS_FILENAME))
+        nt.assert_equal({"slow in C": "answer"}, cache.answers)
+
+    @mock.patch('pbs.main.fill_in_background')
+    @mock.patch('pbs.build.clink_many')
+    @mock.patch('pbs.shard.build_shard')
+    def test_build(self, mock_build, mock_link, mock_fill):
+        """A build links the program, then fills the deferred lookups"""
+        mock_build.return_value = self.manifest
+        nt.assert_equal(0, self.main(['--lookup-budget', '1s']))
+        nt.assert_equal(1.0, mock_build.call_args[0][4])
+        mock_link.assert_called_once_with(
+            self.tmpdirname, os.path.basename(self.tmpdirname))
+        mock_fill.assert_called_once_with(self.tmpdirname, ["slow in C"])
+
+    @mock.patch('pbs.main.fill_in_background')
+    @mock.patch('pbs.build.clink_many')
+    @mock.patch('pbs.shard.build_shard')
+    def test_build_shard(self, mock_build, mock_link, mock_fill):
+        """A shard leaves its manifest, and neither links nor fills"""
+        self.manifest['shard'] = [2, 3]
+        mock_build.return_value = self.manifest
+        nt.assert_equal(0, self.main(['--shard', '2/3']))
+        nt.assert_true(os.path.exists(os.path.join(
+            self.tmpdirname, ".pbs-shard-2-of-3.json")))
+        nt.assert_false(mock_link.called)
+        nt.assert_false(mock_fill.called)
+
+    @mock.patch('pbs.main.fill_in_background')
+    @mock.patch('pbs.build.clink_many')
+    @mock.patch('pbs.shard.merge')
+    def test_merge(self, mock_merge, mock_link, mock_fill):
+        """A merge links the program, then fills the deferred lookups"""
+        mock_merge.return_value = self.manifest
+        nt.assert_equal(0, self.main(['--merge']))
+        nt.assert_true(mock_link.called)
+        mock_fill.assert_called_once_with(self.tmpdirname, ["slow in C"])
+
+    @mock.patch('logging.error')
+    @mock.patch('pbs.build.clink_many')
+    def test_merge_without_manifests(self, mock_link, mock_log):
+        """What happens when there are no shards to merge"""
+        nt.assert_equal(1, self.main(['--merge']))
+        nt.assert_false(mock_link.called)
+        nt.assert_true(mock_log.called)
@@ -0,0 +1,294 @@
+"""
+Tests for the module that splits a build across shards and merges them.
+"""
+import argparse
+import glob
+import json
+import os.path
+import shutil
+import tempfile
+import time
+from textwrap import dedent
+
+import mock
+import nose.tools as nt
+
+import pbs.comments
+import pbs.lookup
+import pbs.shard
+
+
+def test_parse_shard():
+    """How a shard is specified on the command line"""
+    nt.assert_equal((2, 3), pbs.shard.parse_shard("2/3"))
+    for text in ["2", "a/b", "0/3", "4/3", "1/2/3"]:
+        nt.assert_raises(argparse.ArgumentTypeError,
+                         pbs.shard.parse_shard, text)
+
+
+def test_stable_hash():
+    """The hash of a filename does not depend on the process"""
+    nt.assert_equal(pbs.shard.stable_hash("main.c"),
+                    int("2045016cb90d1e65d71c2407a2570927", 16))
+
+
+def test_stable_hash_non_ascii():
+    """Non-ASCII filenames hash the same as bytes and as unicode"""
+    nt.assert_equal(pbs.shard.stable_hash("\xc3\xa9.c"),
+                    pbs.shard.stable_hash(u"\xe9.c"))
+
+
+def test_partition_non_ascii():
+    """Non-ASCII filenames from os.listdir are partitioned by their cost"""
+    # costs are read back from JSON, so their filenames are unicode
+    costs = json.loads(json.dumps(
+        {"\xc3\xa9.c": 5.0, "a.c": 1.0, "b.c": 1.0}))
+    shares = pbs.shard.partition(["a.c", "b.c", "\xc3\xa9.c"], 2, costs)
+    nt.assert_equal([["\xc3\xa9.c"], ["a.c", "b.c"]], shares)
+
+
+def test_partition_non_utf8():
+    """Filenames that are not valid UTF-8 are partitioned without decoding"""
+    costs = {"a.c": 1.0, "b.c": 1.0}
+    shares = pbs.shard.partition(["a.c", "b.c", "caf\xe9.c"], 2, costs)
+    nt.assert_equal(["a.c", "b.c", "caf\xe9.c"], sorted(sum(shares, [])))
+    nt.assert_equal([2, 1], sorted(len(share) for share in shares)[::-1])
+
+
+def test_partition_without_costs():
+    """How files are split evenly when no costs have been recorded"""
+    filenames = ["{0}.c".format(name) for name in "abcdefg"]
+    shares = pbs.shard.partition(filenames, 3)
+    nt.assert_equal([3, 2, 2], sorted(len(share) for share in shares)[::-1])
+    nt.assert_equal(sorted(filenames), sorted(sum(shares, [])))
+    nt.assert_equal(shares, pbs.shard.partition(filenames[::-1], 3))
+
+
+def test_partition_with_costs():
+    """How files are split into shares of similar cost"""
+    costs = {"big.c": 10.0, "a.c": 4.0, "b.c": 3.0, "c.c": 3.0}
+    shares = pbs.shard.partition(sorted(costs) + ["new.c"], 2, costs)
+    # new.c has no recorded cost, so it is assumed to cost the average: 5.0
+    totals = [sum(costs.get(fn, 5.0) for fn in share) for share in shares]
+    nt.assert_equal([12.0, 13.0], sorted(totals))
+    nt.assert_equal(shares, pbs.shard.partition(
+        ["new.c"] + sorted(costs), 2, costs))
+
+
+class TestShards(object):
+    """
+    How a project is built in shards, and how they are merged
+    """
+
+    def __init__(self):
+        self.tmpdirname = None
+        self.parser = pbs.comments.Parser()
+
+    def setup(self):
+        """
+        A project where two files describe a procedure in the same way
+        """
+        self.tmpdirname = tempfile.mkdtemp()
+        sources = {
+            "main.c": ["How to make a no-op"],
+            "helper.c": ["How to make a no-op", "How to decide things"]}
+        for filename, comments in sources.items():
+            with open(os.path.join(self.tmpdirname, filename), 'w') as src:
+                for number, comment in enumerate(comments):
+                    src.write(dedent("""\
+                        /**
+                         * {0}
+                         */
+                        int procedure{1}()
+                        """).format(comment, number))
+        with open(os.path.join(self.tmpdirname, "README"), 'w') as readme:
+            readme.write("not source code")
+
+    def teardown(self):
+        """
+        Cleanup after tests
+        """
+        shutil.rmtree(self.tmpdirname)
+
+    @staticmethod
+    def search(query):
+        """Searches slowly for how to decide things, quickly for the rest."""
+        if query.startswith("How to decide"):
+            time.sleep(0.3)
+        return "answer to " + query
+
+    def build_all(self, count, budget=None):
+        """Builds every shard, as if each was run on a different machine."""
+        with mock.patch('pbs.lookup.search') as mock_search, \
+                mock.patch('pbs.build.ccompile') as mock_compile:
+            mock_search.side_effect = self.search
+            mock_compile.side_effect = lambda path: open(
+                path[:-2] + ".o", 'w').close()
+            manifests = [
+                pbs.shard.build_shard(
+                    self.tmpdirname, self.parser, i, count, budget)
+                for i in range(1, count + 1)]
+        return manifests, mock_search.call_args_list
+
+    def test_lookups_are_not_duplicated(self):
+        """Each query is looked up once across all shards"""
+        manifests, lookups = self.build_all(2)
+        nt.assert_equal(
+            sorted(lookups),
+            [mock.call("How to decide things in C"),
+             mock.call("How to make a no-op in C")])
+        nt.assert_equal([["helper.o"], ["main.o"]],
+                        [manifest['objects'] for manifest in manifests])
+        nt.assert_equal({}, manifests[1]['answers'])
+
+    def test_merge(self):
+        """How shards are merged, and their costs recorded"""
+        manifests, _ = self.build_all(2)
+        for manifest in manifests:
+            pbs.shard.write_manifest(self.tmpdirname, manifest)
+        merged = pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_equal(["helper.o", "main.o"], merged['objects'])
+        nt.assert_equal(3, len(merged['procedures']))
+        for _, _, query in merged['procedures']:
+            nt.assert_equal("answer to " + query, merged['answers'][query])
+        costs = pbs.shard.load_costs(self.tmpdirname)
+        nt.assert_equal(["helper.c", "main.c"], sorted(costs))
+        nt.assert_equal([], glob.glob(os.path.join(
+            self.tmpdirname, pbs.shard.MANIFEST_PATTERN)))
+
+    def test_merge_deferred(self):
+        """Deferred lookups of every shard are merged, answers are cached"""
+        manifests, _ = self.build_all(2, budget=0.1)
+        for manifest in manifests:
+            pbs.shard.write_manifest(self.tmpdirname, manifest)
+        os.remove(os.path.join(self.tmpdirname, pbs.shard.ANSWERS_FILENAME))
+        merged = pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_equal(["How to decide things in C"], merged['deferred'])
+        cache = pbs.lookup.AnswerCache(
+            os.path.join(self.tmpdirname, pbs.shard.ANSWERS_FILENAME))
+        nt.assert_equal({"How to make a no-op in C":
+                         "answer to How to make a no-op in C"}, cache.answers)
+
+    def test_merge_missing_shard(self):
+        """What happens when a shard did not leave its manifest"""
+        nt.assert_raises(ValueError, pbs.shard.merge, self.tmpdirname,
+                         self.parser)
+        manifests, _ = self.build_all(3)
+        pbs.shard.write_manifest(self.tmpdirname, manifests[0])
+        pbs.shard.write_manifest(self.tmpdirname, manifests[2])
+        nt.assert_raises(ValueError, pbs.shard.merge, self.tmpdirname,
+                         self.parser)
+
+    def test_merge_leftover_manifests(self):
+        """Manifests of an earlier build with another number of shards"""
+        self.build_shard(2, 2)
+        for index in range(1, 4):
+            self.build_shard(index, 3)
+        with nt.assert_raises(ValueError) as context:
+            pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_equal(
+            "Found manifests of builds with different numbers of shards: "
+            "shards [2] of 2; shards [1, 2, 3] of 3; remove the manifests of "
+            "earlier builds", str(context.exception))
+
+    def test_merge_missing_object(self):
+        """What happens when an object file was not gathered from a shard"""
+        manifests, _ = self.build_all(1)
+        pbs.shard.write_manifest(self.tmpdirname, manifests[0])
+        os.remove(os.path.join(self.tmpdirname, "main.o"))
+        nt.assert_raises(ValueError, pbs.shard.merge, self.tmpdirname,
+                         self.parser)
+
+    def write_costs(self, costs):
+        """Records costs as if a previous build had been merged."""
+        with open(os.path.join(self.tmpdirname,
+                               pbs.shard.COSTS_FILENAME), 'w') as costs_file:
+            json.dump(costs, costs_file)
+
+    def build_shard(self, index, count):
+        """Builds a single shard, as a runner of a CI pipeline would."""
+        with mock.patch('pbs.lookup.search', side_effect=self.search), \
+                mock.patch('pbs.build.ccompile') as mock_compile:
+            mock_compile.side_effect = lambda path: open(
+                path[:-2] + ".o", 'w').close()
+            manifest = pbs.shard.build_shard(
+                self.tmpdirname, self.parser, index, count)
+        pbs.shard.write_manifest(self.tmpdirname, manifest)
+        return manifest
+
+    def test_merge_different_costs(self):
+        """Shards that partitioned with different costs are not merged"""
+        first = self.build_shard(1, 2)
+        self.write_costs({"helper.c": 1.0, "main.c": 5.0})
+        second = self.build_shard(2, 2)
+        # both shards built the same file, and none built the other one
+        nt.assert_equal(first['share'], second['share'])
+        with nt.assert_raises(ValueError) as context:
+            pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_in("different files or costs", str(context.exception))
+
+    def test_merge_repeated_file(self):
+        """A file built by more than one shard is not merged"""
+        first = self.build_shard(1, 2)
+        second = self.build_shard(2, 2)
+        second['share'] = sorted(second['share'] + first['share'])
+        pbs.shard.write_manifest(self.tmpdirname, second)
+        with nt.assert_raises(ValueError) as context:
+            pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_in("more than one shard: helper.c", str(context.exception))
+
+    def test_merge_source_files_changed(self):
+        """Source files added or removed after the shards were built"""
+        self.build_shard(1, 1)
+        os.rename(os.path.join(self.tmpdirname, "main.c"),
+                  os.path.join(self.tmpdirname, "other.c"))
+        with nt.assert_raises(ValueError) as context:
+            pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_in("built by no shard: other.c", str(context.exception))
+        os.remove(os.path.join(self.tmpdirname, "other.c"))
+        with nt.assert_raises(ValueError) as context:
+            pbs.shard.merge(self.tmpdirname, self.parser)
+        nt.assert_in("no longer found: main.c", str(context.exception))
+
+    def test_costs_guide_the_partition(self):
+        """Recorded costs change which files each shard builds"""
+        manifests, _ = self.build_all(2)
+        nt.assert_equal([["helper.c"], ["main.c"]],
+                        [manifest['share'] for manifest in manifests])
+        self.write_costs({"helper.c": 1.0, "main.c": 5.0})
+        manifests, _ = self.build_all(2)
+        nt.assert_equal([["main.c"], ["helper.c"]],
+                        [manifest['share'] for manifest in manifests])
+        nt.assert_equal([["main.o"], ["helper.o"]],
+                        [manifest['objects'] for manifest in manifests])
+        for manifest in manifests:
+            nt.assert_equal({"helper.c": 1.0, "main.c": 5.0},
+                            manifest['partition_costs'])
+
+    def test_build_non_utf8_filename(self):
+        """A plain build works with a filename that is not valid UTF-8"""
+        shutil.copy(os.path.join(self.tmpdirname, "main.c"),
+                    os.path.join(self.tmpdirname, "caf\xe9.c"))
+        manifests, _ = self.build_all(1)
+        nt.assert_equal(["caf\xe9.o", "helper.o", "main.o"],
+                        manifests[0]['objects'])
+
+    def test_budget_defers_lookups(self):
+        """Lookups pending past the budget are deferred, not waited for"""
+        start = time.time()
+        manifests, _ = self.build_all(1, budget=0.1)
+        nt.assert_less(time.time() - start, 0.3)
+        nt.assert_equal(["How to decide things in C"],
+                        manifests[0]['deferred'])
+        nt.assert_equal(["How to make a no-op in C"],
+                        manifests[0]['answers'].keys())
+        nt.assert_equal(["helper.o", "main.o"], manifests[0]['objects'])
+
+    def test_cached_answers_are_not_looked_up(self):
+        """Answers found by a build are shown by the next without lookups"""
+        first, lookups = self.build_all(1)
+        nt.assert_equal(2, len(lookups))
+        second, lookups = self.build_all(1, budget=0)
+        nt.assert_equal([], lookups)
+        nt.assert_equal([], second[0]['deferred'])
+        nt.assert_equal(first[0]['answers'], second[0]['answers'])